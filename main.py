@@ -1,15 +1,21 @@
 import os
+import re
 import json
 import time
+import threading
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List
 
+import lxml.html
 import numpy as np
 import pandas as pd
 import requests
 import gspread
 from google.oauth2.service_account import Credentials
-from io import StringIO
+from gspread.utils import absolute_range_name
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # -----------------
 # Config (ENV)
@@ -19,14 +25,15 @@ YEAR = int(os.getenv("YEAR", "2025"))
 
 RAW_TAB = os.getenv("RAW_TAB", "raw")
 LEADER_TAB = os.getenv("LEADER_TAB", "leaderboard")
+TOTALS_TAB = os.getenv("TOTALS_TAB", f"_totals_{YEAR}")
 
 REBUILD = os.getenv("REBUILD", "0") == "1"
-APPEND_BATCH_SIZE = int(os.getenv("APPEND_BATCH_SIZE", "500"))
 
 # polite scraping defaults
 REQUEST_SLEEP_SECONDS = float(os.getenv("REQUEST_SLEEP_SECONDS", "0.6"))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "4"))
 TIMEOUT_SECONDS = int(os.getenv("TIMEOUT_SECONDS", "30"))
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "8"))
 
 BASE_URL = "https://www.boxofficemojo.com/date/{date}/"
 
@@ -43,6 +50,23 @@ HEADERS = {
     "Accept-Language": "en-US,en;q=0.9",
 }
 
+# One session for the whole run: keep-alive reuses TCP/TLS connections across
+# the ~365 daily-page fetches, and urllib3's Retry handles transient failures.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=MAX_RETRIES,
+            backoff_factor=0.7,
+            status_forcelist=(429, 500, 502, 503, 504),
+        ),
+    ),
+)
+
 
 # -----------------
 # Google Sheets helpers
@@ -53,182 +77,287 @@ def gs_client():
     return gspread.authorize(creds)
 
 
+def get_totals_ws(sh):
+    try:
+        return sh.worksheet(TOTALS_TAB)
+    except gspread.WorksheetNotFound:
+        return sh.add_worksheet(TOTALS_TAB, rows=2000, cols=4)
+
+
+def load_totals(ws) -> tuple[dict, Optional[int]]:
+    """Read the persisted title -> revenue totals and the raw-tab row marker (D1)."""
+    totals = {}
+    last_raw_row = None
+    vals = ws.get_all_values()
+    if vals and len(vals[0]) >= 4:
+        try:
+            last_raw_row = int(vals[0][3])
+        except ValueError:
+            pass
+    for row in vals:
+        if len(row) >= 2 and row[0]:
+            try:
+                totals[row[0]] = float(row[1])
+            except ValueError:
+                continue
+    return totals, last_raw_row
+
+
+def load_totals_from_raw(ws) -> dict:
+    """Re-aggregate title -> revenue totals from the raw tab (recovery path)."""
+    totals = {}
+    for row in ws.get("A2:C", value_render_option="UNFORMATTED_VALUE") or []:
+        if len(row) >= 3 and row[1]:
+            try:
+                rev = float(row[2])
+            except (TypeError, ValueError):
+                continue
+            title = str(row[1])
+            totals[title] = totals.get(title, 0.0) + rev
+    return totals
+
+
 def ensure_headers(ws):
     if ws.acell("A1").value:
         return
     ws.update([["date", "title", "revenue", "theaters", "distributor"]], range_name="A1:E1")
 
 
-def get_max_date(ws) -> Optional[dt.date]:
-    col_a = ws.col_values(1)
-    if len(col_a) <= 1:
-        return None
+def get_max_date(ws, last_row_hint: Optional[int] = None) -> tuple[Optional[dt.date], bool]:
+    """Return (max date in column A, whether the persisted marker is stale).
+
+    Appends leave the grid's trailing blank region below the data, so the
+    bottom of the grid is not the bottom of the data. Probe from the persisted
+    end-of-data marker instead; the values API omits trailing blank rows, so
+    the response covers just the data tail. The marker is stale when data
+    extends beyond it (or when the sheet has data but no usable marker), i.e.
+    rows exist that were never folded into the persisted totals.
+    """
+    col_a = []
+    if last_row_hint and 2 <= last_row_hint <= ws.row_count:
+        resp = ws.spreadsheet.values_get(
+            absolute_range_name(ws.title, f"A{last_row_hint}:A{ws.row_count}")
+        )
+        col_a = [v[0] for v in resp.get("values", []) if v and v[0]]
+    if col_a:
+        # the probe starts at the marker row itself; more than one row back
+        # means rows were appended after the marker was written
+        stale = len(col_a) > 1
+    else:
+        # no marker yet (or it points past the data): full-column fallback
+        col_a = ws.col_values(1)
+        if len(col_a) <= 1:
+            return None, False
+        stale = True
     last = col_a[-1]
     try:
-        return dt.datetime.strptime(last, "%Y-%m-%d").date()
+        return dt.datetime.strptime(last, "%Y-%m-%d").date(), stale
     except Exception:
-        return None
+        return None, stale
+
 
+def append_rows_batched(ws, rows: List[List], batch_size: int = 40000) -> tuple[int, Optional[int]]:
+    """Append rows in one values.append call; chunk only past the API payload cap.
 
-def append_rows_batched(ws, rows: List[List], batch_size: int = 500) -> int:
+    Returns (rows_added, last_row), where last_row is the end of the data
+    region reported by the API (None when nothing was appended).
+    """
     if not rows:
-        return 0
+        return 0, None
     added = 0
+    last_row = None
     for i in range(0, len(rows), batch_size):
         chunk = rows[i:i + batch_size]
-        ws.append_rows(chunk, value_input_option="USER_ENTERED")
+        resp = ws.spreadsheet.values_append(
+            absolute_range_name(ws.title, "A1"),
+            {"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+            {"values": chunk},
+        )
+        rng = resp.get("updates", {}).get("updatedRange", "")
+        m = re.search(r"(\d+)$", rng)
+        if m:
+            last_row = int(m.group(1))
         added += len(chunk)
-    return added
+    return added, last_row
 
 
 # -----------------
 # BoxOfficeMojo scraping
 # -----------------
-def _parse_money(s) -> int:
-    if pd.isna(s):
-        return 0
-    s = str(s).strip()
-    if not s or s in {"-", "N/A"}:
-        return 0
-    # remove $ and commas
-    s = s.replace("$", "").replace(",", "")
-    # some values might contain footnotes or weird chars; coerce
-    try:
-        return int(float(s))
-    except Exception:
-        return 0
+# Stay polite to boxofficemojo.com while fetching concurrently: cap in-flight
+# requests and keep the aggregate request rate at the sequential default (one
+# request started per REQUEST_SLEEP_SECONDS overall). Concurrency only
+# overlaps the response latency; it must never multiply the request rate.
+_request_gate = threading.Semaphore(SCRAPE_CONCURRENCY)
+_spacing_lock = threading.Lock()
+_last_request_time = 0.0
 
+# compiled once; str.replace would otherwise recompile the pattern per page
+_MONEY_RE = re.compile(r"[\$,]")
 
-def _parse_int(s):
-    if pd.isna(s):
-        return ""
-    s = str(s).strip()
-    if not s or s in {"-", "N/A"}:
-        return ""
-    s = s.replace(",", "")
-    try:
-        return int(s)
-    except Exception:
-        return ""
+
+def _polite_wait():
+    global _last_request_time
+    with _spacing_lock:
+        wait = _last_request_time + REQUEST_SLEEP_SECONDS - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_request_time = time.monotonic()
 
 
 def fetch_daily_table(date_str: str) -> pd.DataFrame:
     """Fetch BOM daily table for a given date (YYYY-MM-DD) and return normalized df."""
     url = BASE_URL.format(date=date_str)
-    last_err = None
 
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            r = requests.get(url, headers=HEADERS, timeout=TIMEOUT_SECONDS)
-            if r.status_code != 200:
-                raise RuntimeError(f"HTTP {r.status_code}")
-
-            # BOM pages usually contain at least one HTML table we can parse
-            tables = pd.read_html(StringIO(r.text))
-            if not tables:
-                raise RuntimeError("No tables found")
-
-            # Pick the table that has 'Release' and 'Daily'
-            df = None
-            for t in tables:
-                cols = [str(c).strip().lower() for c in t.columns]
-                if "release" in cols and "daily" in cols:
-                    df = t.copy()
-                    break
-            if df is None:
-                raise RuntimeError("Expected table with Release/Daily not found")
-
-            # Normalize columns
-            df.columns = [str(c).strip().lower() for c in df.columns]
-
-            # Keep only what we need
-            keep = {}
-            for col in df.columns:
-                if col == "release":
-                    keep[col] = "title"
-                elif col == "daily":
-                    keep[col] = "revenue"
-                elif col == "theaters":
-                    keep[col] = "theaters"
-                elif col == "distributor":
-                    keep[col] = "distributor"
-
-            df = df[list(keep.keys())].rename(columns=keep)
-
-            # Clean values
-            df["date"] = date_str
-            df["revenue"] = df["revenue"].apply(_parse_money)
-            if "theaters" in df.columns:
-                df["theaters"] = df["theaters"].apply(_parse_int)
-            else:
-                df["theaters"] = ""
-
-            if "distributor" not in df.columns:
-                df["distributor"] = ""
-
-            # drop blanks
-            df["title"] = df["title"].astype(str).str.strip()
-            df = df[df["title"] != ""].copy()
-
-            # polite sleep
-            time.sleep(REQUEST_SLEEP_SECONDS)
-            return df[["date", "title", "revenue", "theaters", "distributor"]]
-
-        except Exception as e:
-            last_err = e
-            # exponential-ish backoff
-            time.sleep(min(8, 0.7 * attempt))
-
-    raise RuntimeError(f"Failed to fetch {date_str}: {last_err}")
-
-
-def date_range(start: dt.date, end: dt.date):
-    d = start
-    while d <= end:
-        yield d
-        d += dt.timedelta(days=1)
+    with _request_gate:
+        _polite_wait()
+        r = SESSION.get(url, timeout=TIMEOUT_SECONDS)
+    if r.status_code != 200:
+        raise RuntimeError(f"Failed to fetch {date_str}: HTTP {r.status_code}")
+
+    # Parse the page once and pick the table that has 'Release' and 'Daily';
+    # pd.read_html would build a DataFrame for every table on the page.
+    tree = lxml.html.fromstring(r.content)
+    trs = tree.xpath("(//table[.//th[normalize-space()='Release']])[1]//tr")
+    if not trs:
+        raise RuntimeError(f"Expected table with Release/Daily not found for {date_str}")
+
+    header = [c.text_content().strip().lower() for c in trs[0]]
+    col_idx = {name: i for i, name in enumerate(header)}
+    if "release" not in col_idx or "daily" not in col_idx:
+        raise RuntimeError(f"Expected table with Release/Daily not found for {date_str}")
+
+    ti = col_idx["release"]
+    ri = col_idx["daily"]
+    hi = col_idx.get("theaters")
+    di = col_idx.get("distributor")
+
+    titles, revenues, theaters, distributors = [], [], [], []
+    for tr in trs[1:]:
+        cells = [c.text_content().strip() for c in tr]
+        if len(cells) <= max(ti, ri):
+            continue
+        titles.append(cells[ti])
+        revenues.append(cells[ri])
+        theaters.append(cells[hi] if hi is not None and hi < len(cells) else "")
+        distributors.append(cells[di] if di is not None and di < len(cells) else "")
+
+    df = pd.DataFrame(
+        {
+            "title": titles,
+            "revenue": revenues,
+            "theaters": theaters,
+            "distributor": distributors,
+        }
+    )
+
+    # Clean values (vectorized; '-'/'N/A'/blank coerce to NaN)
+    df["date"] = date_str
+    rev = df["revenue"].astype(str).str.replace(_MONEY_RE, "", regex=True).str.strip()
+    df["revenue"] = pd.to_numeric(rev, errors="coerce").fillna(0).astype("int64")
+    th = df["theaters"].astype(str).str.replace(",", "", regex=False).str.strip()
+    df["theaters"] = pd.to_numeric(th, errors="coerce")
+
+    # drop blanks
+    df["title"] = df["title"].astype(str).str.strip()
+    df = df[df["title"] != ""].copy()
+
+    return df[["date", "title", "revenue", "theaters", "distributor"]]
 
 
 def scrape_year(start_date: dt.date, end_date: dt.date) -> pd.DataFrame:
-    frames = []
-    for d in date_range(start_date, end_date):
-        ds = d.strftime("%Y-%m-%d")
-        day_df = fetch_daily_table(ds)
-        frames.append(day_df)
+    date_strs = pd.date_range(start_date, end_date, freq="D").strftime("%Y-%m-%d").tolist()
+    with ThreadPoolExecutor(max_workers=SCRAPE_CONCURRENCY) as ex:
+        frames = list(ex.map(fetch_daily_table, date_strs))
     if not frames:
         return pd.DataFrame(columns=["date", "title", "revenue", "theaters", "distributor"])
-    return pd.concat(frames, ignore_index=True)
+    df = pd.concat(frames, ignore_index=True)
+    # Compact dtypes: the object string columns dominate memory for a full
+    # year, and category codes make the downstream aggregation cheaper.
+    df["revenue"] = df["revenue"].astype("int64")
+    df["theaters"] = df["theaters"].astype("Int32")
+    for c in ("title", "distributor"):
+        df[c] = df[c].astype("category")
+    return df
+
+
+def build_rows(df_new: pd.DataFrame) -> List[List]:
+    """Turn a scraped DataFrame into Sheets row payloads, columnwise (no iterrows)."""
+    if df_new.empty:
+        return []
+    if pd.api.types.is_datetime64_any_dtype(df_new["date"]):
+        dates = df_new["date"].dt.strftime("%Y-%m-%d").tolist()
+    else:
+        dates = df_new["date"].astype(str).tolist()
+    titles = df_new["title"].astype(str).tolist()
+    # revenue is already int64 and theaters Int32 (scrape_year invariants);
+    # no re-coercion needed, just NA -> blank for the sheet.
+    rev = df_new["revenue"].astype(float).tolist()
+    theaters = [int(x) if pd.notna(x) else "" for x in df_new["theaters"]]
+    dist = df_new["distributor"].astype(str).tolist()
+    return list(map(list, zip(dates, titles, rev, theaters, dist)))
+
+
+def accumulate_totals(totals: dict, df_new: pd.DataFrame) -> dict:
+    """Fold newly scraped rows into the running title -> revenue totals."""
+    for t, r in zip(df_new["title"].astype(str).to_numpy(), df_new["revenue"].to_numpy()):
+        totals[t] = totals.get(t, 0.0) + float(r)
+    return totals
 
 
 # -----------------
 # Leaderboard writing (tie-break alphabetic)
 # -----------------
-def write_leaderboard(sh, df_year: pd.DataFrame, year: int):
-    ws = sh.worksheet(LEADER_TAB)
-    ws.clear()
-    ws.update("A1", [[f"Leaderboard {year} (calendar daily sum; tie-break: alphabetic)"]])
-
-    if df_year.empty:
-        ws.update("A3", [["No data yet."]])
-        return
-
-    totals = (
-        df_year.groupby("title", as_index=False)["revenue"].sum()
-        .sort_values(["revenue", "title"], ascending=[False, True])
+def write_leaderboard(sh, totals: dict, year: int, last_raw_row: Optional[int] = None):
+    """Write the leaderboard tab and persist the running totals, in one batch."""
+    sh.values_batch_clear(
+        body={"ranges": [absolute_range_name(LEADER_TAB), absolute_range_name(TOTALS_TAB)]}
     )
-    winner = totals.iloc[0]
 
-    ws.update("A3", [["Winner (current):", winner["title"], float(winner["revenue"])]])
+    # One values.batchUpdate for all ranges instead of a round-trip per update.
+    data = [
+        {
+            "range": absolute_range_name(LEADER_TAB, "A1"),
+            "values": [[f"Leaderboard {year} (calendar daily sum; tie-break: alphabetic)"]],
+        }
+    ]
 
-    top50 = totals.head(50).copy()
-    top50.insert(0, "rank", range(1, len(top50) + 1))
+    # Title cardinality is a few hundred per year; a plain dict pass plus one
+    # sort beats a pandas groupby + sort here.
+    ranked = sorted(totals.items(), key=lambda kv: (-kv[1], kv[0]))
 
-    ws.update("A5", [["Rank", "Title", "Revenue"]])
-    ws.update(
-        "A6",
-        top50[["rank", "title", "revenue"]].values.tolist(),
-        value_input_option="USER_ENTERED",
-    )
+    if not ranked:
+        data.append({"range": absolute_range_name(LEADER_TAB, "A3"), "values": [["No data yet."]]})
+    else:
+        winner_title, winner_revenue = ranked[0]
+
+        top50 = [[i + 1, t, float(r)] for i, (t, r) in enumerate(ranked[:50])]
+
+        data += [
+            {
+                "range": absolute_range_name(LEADER_TAB, "A3"),
+                "values": [["Winner (current):", winner_title, float(winner_revenue)]],
+            },
+            {"range": absolute_range_name(LEADER_TAB, "A5"), "values": [["Rank", "Title", "Revenue"]]},
+            {"range": absolute_range_name(LEADER_TAB, "A6"), "values": top50},
+        ]
+
+    sh.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+
+    # The totals/marker state must round-trip losslessly, so it goes out in a
+    # separate RAW batch: USER_ENTERED would let the grid coerce date-like
+    # titles ("9/11", fractions, ...) into different strings, permanently
+    # splitting those films' totals across two keys on the next load.
+    state = []
+    if ranked:
+        state.append(
+            {"range": absolute_range_name(TOTALS_TAB, "A1"), "values": [[t, float(r)] for t, r in ranked]}
+        )
+    if last_raw_row is not None:
+        # end-of-data marker for the raw tab; get_max_date probes from here
+        state.append({"range": absolute_range_name(TOTALS_TAB, "D1"), "values": [[int(last_raw_row)]]})
+    if state:
+        sh.values_batch_update({"valueInputOption": "RAW", "data": state})
 
 
 def main():
@@ -250,10 +379,17 @@ def main():
     # don't scrape future dates
     effective_end = min(year_end, today)
 
-    max_date = None if REBUILD else get_max_date(raw)
+    # Load persisted state up front: the running totals plus the raw-tab
+    # end-of-data marker that lets get_max_date probe just the data tail.
+    totals_ws = get_totals_ws(sh)
+    totals, last_raw_row = ({}, None) if REBUILD else load_totals(totals_ws)
+
+    max_date, marker_stale = (None, False) if REBUILD else get_max_date(raw, last_raw_row)
     if max_date:
         start = max(max_date + dt.timedelta(days=1), year_start)
     else:
+        # empty (or unreadable) raw tab: full scrape, totals start fresh
+        totals = {}
         start = year_start
 
     if start > effective_end:
@@ -264,23 +400,23 @@ def main():
 
     df_year = scrape_year(start, effective_end)
 
+    if (not totals or marker_stale) and not REBUILD and max_date is not None:
+        # The persisted totals can't be trusted: either the totals tab is
+        # empty while raw has data, or rows sit beyond the end-of-data marker
+        # (a prior run died between the append and the totals write, leaving
+        # appended revenue the totals never saw). Re-aggregate from raw —
+        # before appending today's rows — instead of silently publishing a
+        # leaderboard missing that revenue.
+        totals = load_totals_from_raw(raw)
+
     # Append rows
-    rows = df_year.values.tolist()
-    added = append_rows_batched(raw, rows, APPEND_BATCH_SIZE)
-
-    # For leaderboard, we want full-year totals so far.
-    # Easiest: re-read raw tab (only columns we need) once.
-    # This is fine at ~tens of thousands of rows.
-    raw_vals = raw.get_all_values()
-    if len(raw_vals) <= 1:
-        df_all = df_year
-    else:
-        headers = raw_vals[0]
-        data = raw_vals[1:]
-        df_all = pd.DataFrame(data, columns=headers)
-        df_all["revenue"] = pd.to_numeric(df_all["revenue"], errors="coerce").fillna(0).astype(int)
+    rows = build_rows(df_year)
+    added, appended_last_row = append_rows_batched(raw, rows)
+    if appended_last_row is not None:
+        last_raw_row = appended_last_row
 
-    write_leaderboard(sh, df_all[["title", "revenue"]], YEAR)
+    accumulate_totals(totals, df_year)
+    write_leaderboard(sh, totals, YEAR, last_raw_row)
 
     # simple log
     dates = df_year["date"]